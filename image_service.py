@@ -1,14 +1,19 @@
 import os
 import httpx
-import base64
-import uuid
+import pybase64
+import secrets
 import time
-import json
+import orjson
 import random
+import struct
+import hashlib
+import tempfile
 from datetime import datetime
 from dotenv import load_dotenv
-from PIL import Image, ImageOps, ImageDraw, ImageFilter
+from diskcache import Cache
+from PIL import Image, ImageFile, ImageOps, ImageDraw, ImageFilter
 from io import BytesIO
+import numpy as np
 import asyncio
 import logging
 
@@ -24,70 +29,158 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 if not GEMINI_API_KEY:
     logger.warning("GEMINI_API_KEY not set. Image generation will be disabled. Please set GEMINI_API_KEY in .env file.")
 
+# HTTP-клиент для Gemini API создается один раз на приложение (server.py, startup)
+# и передается в генерацию: пул соединений и TLS-сессии переиспользуются между запросами
+def create_http_client() -> httpx.AsyncClient:
+    """Создает HTTP/2-клиент для Gemini API с пулом keep-alive соединений"""
+    # Короткий connect-таймаут: недоступный upstream выявляется за секунды,
+    # а не держит запрос все 60 секунд, отведенные на генерацию
+    return httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(60.0, connect=5.0),
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=100, keepalive_expiry=60),
+    )
+
 # Временное отключение генерации изображений
 ENABLE_IMAGE_GENERATION = True
 IMAGE_GENERATION_MESSAGE = "🎨 Генерация изображений временно недоступна из-за ограничений API. Попробуйте позже."
 
 # Папка для сохранения изображений
 UPLOAD_FOLDER = 'generated_images'
-METADATA_FILE = os.path.join(UPLOAD_FOLDER, 'metadata.json')
+# Метаданные храним как журнал NDJSON: одна JSON-запись на строку, только дозапись
+METADATA_FILE = os.path.join(UPLOAD_FOLDER, 'metadata.ndjson')
+LEGACY_METADATA_FILE = os.path.join(UPLOAD_FOLDER, 'metadata.json')
 
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
+# Дисковый кеш результатов генерации (промпт -> изображение) и время жизни
+# записей в секундах; PROMPT_CACHE_TTL=0 отключает кеш. Папка кеша лежит вне
+# UPLOAD_FOLDER, которая раздается как статика
+PROMPT_CACHE_DIR = os.getenv("PROMPT_CACHE_DIR", os.path.join('.cache', 'prompts'))
+PROMPT_CACHE_TTL = int(os.getenv("PROMPT_CACHE_TTL", str(7 * 24 * 3600)))
+_PROMPT_CACHE = Cache(PROMPT_CACHE_DIR)
+
+# Сигнатура PNG-файла
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# Уровень zlib-сжатия при PNG-кодировании (0-9): 1 кодирует в разы быстрее
+# уровня 6 по умолчанию ценой немного большего файла
+PNG_COMPRESS_LEVEL = int(os.getenv("PNG_COMPRESS_LEVEL", "1"))
+
+# Энкодер PIL пишет блоками MAXBLOCK (по умолчанию 64 КиБ): для PNG в несколько
+# мегабайт блок 4 МиБ сокращает число write() в десятки раз
+ImageFile.MAXBLOCK = 4 * 1024 * 1024
+
+# Индекс метаданных в памяти (filename -> запись) и отметка (mtime_ns, size)
+# файла журнала, по которой он был построен
+_META_CACHE = None
+_META_STAMP = None
+
+def _metadata_stamp():
+    """Возвращает отметку изменения журнала метаданных или None, если его нет"""
+    try:
+        st = os.stat(METADATA_FILE)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def _metadata_line(filename, record):
+    """Сериализует запись метаданных в строку NDJSON"""
+    return orjson.dumps({'filename': filename, **record}, option=orjson.OPT_APPEND_NEWLINE)
+
 def load_metadata():
     """Загружает метаданные изображений"""
+    global _META_CACHE, _META_STAMP
+    # Перечитываем журнал, только если его изменили (в т.ч. другой процесс)
+    stamp = _metadata_stamp()
+    if _META_CACHE is not None and stamp == _META_STAMP:
+        return _META_CACHE
+
+    metadata = {}
+
+    # Подхватываем записи из старого формата metadata.json, если он остался
+    if os.path.exists(LEGACY_METADATA_FILE):
+        try:
+            with open(LEGACY_METADATA_FILE, 'rb') as f:
+                legacy = orjson.loads(f.read())
+            if isinstance(legacy, dict):
+                # Записи не-объекты сломали бы list_images — пропускаем их
+                metadata.update((name, record) for name, record in legacy.items() if isinstance(record, dict))
+            else:
+                logger.warning(f"Пропущен {LEGACY_METADATA_FILE}: ожидался объект, получен {type(legacy).__name__}")
+        except (orjson.JSONDecodeError, OSError) as e:
+            logger.error(f"Не удалось прочитать {LEGACY_METADATA_FILE}: {e}")
+
+    # Читаем журнал построчно; при повторе имени файла побеждает последняя запись
     if os.path.exists(METADATA_FILE):
         try:
-            with open(METADATA_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            return {}
-    return {}
-
-def save_metadata(metadata):
-    """Сохраняет метаданные изображений"""
-    try:
-        with open(METADATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        logger.error(f"Ошибка сохранения метаданных: {e}")
+            with open(METADATA_FILE, 'rb') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        record = orjson.loads(line)
+                    except orjson.JSONDecodeError:
+                        logger.warning(f"Пропущена поврежденная строка в {METADATA_FILE}")
+                        continue
+                    if not isinstance(record, dict) or not isinstance(record.get('filename'), str):
+                        logger.warning(f"Пропущена запись без имени файла в {METADATA_FILE}")
+                        continue
+                    metadata[record.pop('filename')] = record
+        except OSError as e:
+            logger.error(f"Не удалось прочитать {METADATA_FILE}: {e}")
+
+    _META_CACHE = metadata
+    _META_STAMP = stamp
+    return metadata
 
 def add_image_metadata(filename, width, height, prompt, model, generation_time):
     """Добавляет метаданные для нового изображения"""
-    metadata = load_metadata()
-    metadata[filename] = {
+    global _META_STAMP
+    record = {
         'width': width,
         'height': height,
         'prompt': prompt,
         'model': model,
         'generation_time': generation_time,
-        'created': datetime.now().isoformat()
+        'created': datetime.now().isoformat(),
+        'created_ts': time.time()
     }
-    save_metadata(metadata)
+    stamp_before = _metadata_stamp()
+    try:
+        with open(METADATA_FILE, 'ab') as f:
+            f.write(_metadata_line(filename, record))
+    except Exception as e:
+        logger.error(f"Ошибка сохранения метаданных: {e}")
+        return
+
+    # Если журнал не меняли с момента построения кеша, дополняем кеш на месте,
+    # иначе он будет перечитан при следующем load_metadata()
+    if _META_CACHE is not None and stamp_before == _META_STAMP:
+        _META_CACHE[filename] = record
+        _META_STAMP = _metadata_stamp()
 
 # Функции для работы с Gemini API
+
+# Допустимые соотношения сторон Gemini API и их числовые значения
+_AR_TABLE = tuple(
+    (name, int(a) / int(b))
+    for name in ['1:1','2:3','3:2','3:4','4:3','4:5','5:4','9:16','16:9','21:9']
+    for a, b in [name.split(':')]
+)
+
 def get_aspect_ratio(width, height):
     """Определяет ближайшее допустимое соотношение сторон для Gemini API"""
-    allowed = ['1:1','2:3','3:2','3:4','4:3','4:5','5:4','9:16','16:9','21:9']
     target = width / height
-    best = allowed[0]
-    best_diff = float('inf')
-    for ar in allowed:
-        a, b = map(int, ar.split(':'))
-        ratio = a / b
-        diff = abs(ratio - target)
-        if diff < best_diff:
-            best_diff = diff
-            best = ar
-    return best
+    return min(_AR_TABLE, key=lambda nr: abs(nr[1] - target))[0]
 
 def generate_prompt_for_size(prompt: str, width: int, height: int) -> str:
     """Генерирует расширенный промпт с указанием размера"""
     return f"{prompt}\n\nIMPORTANT: Fill the entire frame completely. No black bars, no letterboxing, no pillarboxing. The image should extend to all edges of the canvas."
 
 # Функция для обработки черных полос в DALL-E 3 изображениях
-async def fill_black_borders(img, prompt: str) -> Image.Image:
+def fill_black_borders(img, prompt: str) -> Image.Image:
     """Заполняет черные полосы в изображениях DALL-E 3"""
     if img.mode != 'RGB':
         img = img.convert('RGB')
@@ -95,35 +188,21 @@ async def fill_black_borders(img, prompt: str) -> Image.Image:
     width, height = img.size
     black_threshold = 30
 
-    # Определяем толщину черных полей
-    def scan_top():
-        for y in range(height):
-            if any(img.getpixel((x, y))[c] > black_threshold for x in range(width) for c in range(3)):
-                return y
-        return 0
-
-    def scan_bottom():
-        for y in range(height - 1, -1, -1):
-            if any(img.getpixel((x, y))[c] > black_threshold for x in range(width) for c in range(3)):
-                return height - 1 - y
-        return 0
-
-    def scan_left():
-        for x in range(width):
-            if any(img.getpixel((x, y))[c] > black_threshold for y in range(height) for c in range(3)):
-                return x
-        return 0
-
-    def scan_right():
-        for x in range(width - 1, -1, -1):
-            if any(img.getpixel((x, y))[c] > black_threshold for y in range(height) for c in range(3)):
-                return width - 1 - x
-        return 0
-
-    top_thick = scan_top()
-    bottom_thick = scan_bottom()
-    left_thick = scan_left()
-    right_thick = scan_right()
+    # Определяем толщину черных полей векторно: строки/столбцы, где есть
+    # хотя бы один пиксель светлее порога
+    mask = (np.asarray(img) > black_threshold).any(axis=2)
+    row_has = mask.any(axis=1)
+    col_has = mask.any(axis=0)
+
+    if row_has.any():
+        top_thick = int(np.argmax(row_has))
+        bottom_thick = int(np.argmax(row_has[::-1]))
+        left_thick = int(np.argmax(col_has))
+        right_thick = int(np.argmax(col_has[::-1]))
+    else:
+        # Изображение полностью черное
+        top_thick = bottom_thick = height
+        left_thick = right_thick = width
 
     logger.info(f"Detected border thicknesses - top: {top_thick}px, bottom: {bottom_thick}px, left: {left_thick}px, right: {right_thick}px")
 
@@ -137,7 +216,25 @@ async def fill_black_borders(img, prompt: str) -> Image.Image:
     logger.info("Возвращаем изображение без дополнительной обработки черных полос")
     return img
 
-async def generate_image_with_retry(prompt: str, width: int = 1024, height: int = 1024, reference_image: str = None, max_retries: int = 3) -> str:
+# Circuit breaker для rate limit: после RATE_LIMIT_BREAKER_THRESHOLD ответов 429
+# подряд новые запросы сразу отклоняются на RATE_LIMIT_BREAKER_COOLDOWN секунд,
+# чтобы не добивать Gemini API повторами
+RATE_LIMIT_BREAKER_THRESHOLD = 5
+RATE_LIMIT_BREAKER_COOLDOWN = 30
+_circuit = {"consecutive_429": 0, "open_until": 0.0}
+# Верхняя граница паузы: большой Retry-After не должен держать запрос минутами
+RATE_LIMIT_MAX_DELAY = 60
+
+def _retry_delay(resp: httpx.Response, default: float) -> float:
+    """Пауза перед повтором: Retry-After из ответа (или default) со случайным разбросом"""
+    try:
+        base = float(resp.headers.get("retry-after", default))
+    except ValueError:
+        base = default
+    # Разброс ±50%, чтобы одновременно упершиеся в лимит запросы не повторялись синхронно
+    return min(max(base, 0.0) * (0.5 + random.random()), RATE_LIMIT_MAX_DELAY)
+
+async def generate_image_with_retry(prompt: str, width: int = 1024, height: int = 1024, reference_image: str = None, max_retries: int = 3, *, client: httpx.AsyncClient) -> str:
     """Генерирует изображение через Gemini API с повторными попытками"""
     api_key = GEMINI_API_KEY
     if not api_key:
@@ -147,6 +244,13 @@ async def generate_image_with_retry(prompt: str, width: int = 1024, height: int
     enhanced_prompt = generate_prompt_for_size(prompt, width, height)
     
     for attempt in range(max_retries):
+        if _circuit["open_until"]:
+            if time.monotonic() < _circuit["open_until"]:
+                raise Exception("Rate limit exceeded, please try again later")
+            # Пауза истекла: счетчик с нуля, иначе первый же 429 снова откроет breaker
+            _circuit["open_until"] = 0.0
+            _circuit["consecutive_429"] = 0
+
         try:
             logger.info(f"Generating image with Gemini API (attempt {attempt + 1}/{max_retries})")
             logger.info(f"Aspect ratio: {aspect_ratio}, Prompt: {enhanced_prompt[:100]}...")
@@ -186,44 +290,55 @@ async def generate_image_with_retry(prompt: str, width: int = 1024, height: int
             }
 
             # Отправляем запрос к Gemini API
-            async with httpx.AsyncClient(timeout=60) as client:
-                resp = await client.post(GEMINI_URL, headers=headers, json=payload)
+            resp = await client.post(GEMINI_URL, headers=headers, content=orjson.dumps(payload))
 
             if resp.status_code == 429:
                 # Обработка rate limit
-                retry_after = 10
-                logger.warning(f"Rate limit exceeded, retrying in {retry_after} seconds")
-                await asyncio.sleep(retry_after)
+                _circuit["consecutive_429"] += 1
+                if _circuit["consecutive_429"] >= RATE_LIMIT_BREAKER_THRESHOLD:
+                    _circuit["open_until"] = time.monotonic() + RATE_LIMIT_BREAKER_COOLDOWN
+                    logger.warning(f"Rate limit hit {_circuit['consecutive_429']} times in a row, pausing requests for {RATE_LIMIT_BREAKER_COOLDOWN}s")
+                    continue
+                if attempt < max_retries - 1:
+                    retry_after = _retry_delay(resp, 10)
+                    logger.warning(f"Rate limit exceeded, retrying in {retry_after:.1f} seconds")
+                    await asyncio.sleep(retry_after)
                 continue
 
             elif resp.status_code == 400:
                 # Обработка ошибок валидации
-                error_data = resp.json()
+                error_data = orjson.loads(resp.content)
                 error_msg = error_data.get("error", {}).get("message", "Validation error")
                 raise Exception(f"Validation error: {error_msg}")
 
             resp.raise_for_status()
-            resp_json = resp.json()
+            _circuit["consecutive_429"] = 0
+            resp_json = orjson.loads(resp.content)
             
-            logger.info(f"Gemini API response structure: {list(resp_json.keys())}")
+            debug = logger.isEnabledFor(logging.DEBUG)
+            if debug:
+                logger.debug(f"Gemini API response structure: {list(resp_json.keys())}")
 
             # Извлекаем изображение из ответа
             candidates = resp_json.get("candidates", [])
-            logger.info(f"Found {len(candidates)} candidates in response")
-            
+            if debug:
+                logger.debug(f"Found {len(candidates)} candidates in response")
+
             for i, candidate in enumerate(candidates):
-                logger.info(f"Processing candidate {i+1}")
                 content = candidate.get("content", {})
                 parts = content.get("parts", [])
-                logger.info(f"Candidate {i+1} has {len(parts)} parts")
-                
+                if debug:
+                    logger.debug(f"Candidate {i+1} has {len(parts)} parts")
+
                 for j, part in enumerate(parts):
-                    logger.info(f"Processing part {j+1}, keys: {list(part.keys())}")
-                    
+                    if debug:
+                        logger.debug(f"Processing part {j+1}, keys: {list(part.keys())}")
+
                     # Проверяем различные возможные форматы
                     inline = part.get("inlineData") or part.get("inline_data")
                     if inline:
-                        logger.info(f"Found inline data, keys: {list(inline.keys())}")
+                        if debug:
+                            logger.debug(f"Found inline data, keys: {list(inline.keys())}")
                         if inline.get("data"):
                             img_b64 = inline["data"]
                             logger.info("Image generated successfully with Gemini API")
@@ -232,21 +347,22 @@ async def generate_image_with_retry(prompt: str, width: int = 1024, height: int
                             img_b64 = inline["data"]
                             logger.info("Image generated successfully with Gemini API (with mimeType)")
                             return img_b64
-                    
+
                     # Проверяем прямой формат
                     if "data" in part:
                         img_b64 = part["data"]
                         logger.info("Image generated successfully with Gemini API (direct data)")
                         return img_b64
 
-            logger.error(f"No image found in response. Full response: {resp_json}")
+            # Ответ может содержать мегабайты base64, в лог пишем только начало
+            logger.error(f"No image found in response. Response: {str(resp_json)[:500]}")
             raise Exception("No image in response")
 
         except httpx.HTTPStatusError as e:
             if e.response.status_code == 429:
                 if attempt < max_retries - 1:
-                    retry_after = 10
-                    logger.warning(f"Rate limit, retrying in {retry_after}s (attempt {attempt + 1})")
+                    retry_after = _retry_delay(e.response, 10)
+                    logger.warning(f"Rate limit, retrying in {retry_after:.1f}s (attempt {attempt + 1})")
                     await asyncio.sleep(retry_after)
                     continue
                 else:
@@ -258,13 +374,25 @@ async def generate_image_with_retry(prompt: str, width: int = 1024, height: int
         except Exception as e:
             if attempt < max_retries - 1:
                 logger.warning(f"Gemini API error (attempt {attempt + 1}): {e}")
-                await asyncio.sleep(2 ** attempt)  # Exponential backoff
+                await asyncio.sleep(2 ** attempt * (0.5 + random.random()))  # Exponential backoff с разбросом
                 continue
             else:
                 raise Exception(f"Gemini API generation failed after {max_retries} attempts: {str(e)}")
 
-async def generate_image_async(prompt: str, width: int = 1024, height: int = 1024, reference_image: str = None) -> dict:
-    """Асинхронная генерация изображения через Gemini API"""
+    # Все попытки закончились ответом 429
+    raise Exception("Rate limit exceeded, please try again later")
+
+def _prompt_cache_key(prompt: str, width: int, height: int, reference_image: str = None) -> str:
+    """Ключ кеша генерации: промпт, размер и (если есть) референсное изображение"""
+    digest = hashlib.sha256(f"{prompt}|{width}x{height}".encode('utf-8'))
+    if reference_image:
+        digest.update(b'|')
+        digest.update(reference_image.encode('utf-8'))
+    return digest.hexdigest()
+
+async def generate_image_async(prompt: str, width: int = 1024, height: int = 1024, reference_image: str = None, *, client: httpx.AsyncClient, use_cache: bool = True) -> dict:
+    """Асинхронная генерация изображения через Gemini API (client — HTTP-клиент приложения).
+    use_cache=False пропускает поиск в кеше промптов, но кладет туда новый результат"""
     try:
         import time
         start_time = time.time()
@@ -277,17 +405,28 @@ async def generate_image_async(prompt: str, width: int = 1024, height: int = 102
         if not ENABLE_IMAGE_GENERATION:
             return {"error": IMAGE_GENERATION_MESSAGE}
 
+        # Повторный запрос с тем же промптом отдаем из дискового кеша
+        cache_key = _prompt_cache_key(prompt, width, height, reference_image)
+        if use_cache and PROMPT_CACHE_TTL > 0:
+            cached = await asyncio.to_thread(_PROMPT_CACHE.get, cache_key)
+            if cached is not None:
+                logger.info("Image found in prompt cache")
+                return cached
+
         # Генерируем изображение через Gemini API
-        image_b64 = await generate_image_with_retry(prompt, width, height, reference_image)
+        image_b64 = await generate_image_with_retry(prompt, width, height, reference_image, client=client)
 
         generation_time = time.time() - start_time
         logger.info(f"Image generated in {generation_time:.2f} seconds")
 
-        return {
+        result = {
             "image_b64": image_b64,
             "generation_time": generation_time,
             "model": "Gemini 2.5 Flash Image Preview"
         }
+        if PROMPT_CACHE_TTL > 0:
+            await asyncio.to_thread(_PROMPT_CACHE.set, cache_key, result, expire=PROMPT_CACHE_TTL)
+        return result
 
     except Exception as e:
         logger.error(f"Error generating image: {e}")
@@ -301,9 +440,89 @@ def generate_image_new(prompt: str, width: int = 1024, height: int = 1024) -> di
     test_png = "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
     return {"image_b64": test_png}
 
-def generate_image(prompt: str, width: int = 1024, height: int = 1024) -> dict:
-    """Генерирует изображение и возвращает результат"""
-    return generate_image_new(prompt, width, height)
+# Генерирует изображение и возвращает результат
+generate_image = generate_image_new
+
+def png_dimensions(data: bytes) -> tuple[int, int] | None:
+    """Возвращает (ширина, высота) из заголовка IHDR или None, если это не PNG"""
+    if len(data) < 24 or data[:8] != PNG_SIGNATURE or data[12:16] != b'IHDR':
+        return None
+    return struct.unpack('>II', data[16:24])
+
+def atomic_write(filepath: str, write) -> None:
+    """Пишет файл через временный файл и os.replace, чтобы никто не увидел недописанный PNG"""
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(filepath) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        # mkstemp создает файл с правами 0600 — статике нужно чтение
+        os.chmod(tmppath, 0o644)
+        os.replace(tmppath, filepath)
+    except BaseException:
+        try:
+            os.unlink(tmppath)
+        except OSError:
+            pass
+        raise
+
+def _write_all(fd: int, data: bytes) -> None:
+    """Пишет байты в дескриптор через os.write, дописывая при частичной записи"""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+def atomic_write_bytes(filepath: str, data: bytes) -> None:
+    """Атомарно записывает готовые байты прямо в дескриптор, минуя буфер Python"""
+    atomic_write(filepath, lambda f: _write_all(f.fileno(), data))
+
+def _save_sync(image_data: bytes, filepath: str, width: int, height: int) -> tuple[int, int]:
+    """Приводит изображение к целевому размеру и записывает его на диск, возвращает итоговый размер"""
+    # PNG уже нужного размера в 8-битном RGB: размеры берем из заголовка IHDR
+    # и пишем исходные байты как есть, без декодирования и перекодирования
+    if png_dimensions(image_data) == (width, height) and image_data[24:26] == b'\x08\x02':
+        logger.info(f"Изображение уже нужного размера {width}x{height}, сохраняем без обработки")
+        atomic_write_bytes(filepath, image_data)
+        return width, height
+
+    # Обрабатываем изображение с помощью PIL
+    try:
+        with Image.open(BytesIO(image_data)) as img:
+            # JPEG libjpeg умеет уменьшать в 2/4/8 раз прямо при декодировании:
+            # draft выбирает наименьший масштаб, не меньше целевого размера
+            if img.format == 'JPEG':
+                img.draft('RGB', (width, height))
+
+            # Конвертируем в RGB если нужно
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+
+            original_size = img.size
+            logger.info(f"Исходный размер изображения от Gemini: {original_size}")
+            logger.info(f"Целевой размер: {width}x{height}")
+
+            # При масштабе в пределах 0.5-2x BILINEAR визуально не отличим от
+            # LANCZOS и в разы дешевле; широкое ядро LANCZOS нужно только
+            # для сильного масштабирования
+            ratio = min(width / original_size[0], height / original_size[1])
+            scale = max(ratio, 1 / ratio)
+            method = Image.Resampling.BILINEAR if scale <= 2.0 else Image.Resampling.LANCZOS
+
+            # Вписываем изображение в целевой размер с сохранением пропорций
+            # БЕЗ обрезки и центрируем на черном фоне. ImageOps.pad делает
+            # масштабирование и вставку за один вызов; если пропорции уже
+            # совпадают, черный холст вообще не создается
+            result = ImageOps.pad(img, (width, height), method=method, color=(0, 0, 0))
+
+            logger.info(f"Финальный размер: {result.size}")
+
+            # Сохраняем как PNG
+            atomic_write(filepath, lambda f: result.save(f, 'PNG', compress_level=PNG_COMPRESS_LEVEL, optimize=False))
+            return result.size
+
+    except Exception as e:
+        # Если PIL не может обработать, сохраняем как есть
+        atomic_write_bytes(filepath, image_data)
+        return width, height
 
 async def save_image(image_b64: str, prompt: str = "Unknown prompt", width: int = 1024, height: int = 1024) -> dict:
     """Сохраняет изображение из base64 на сервере"""
@@ -311,61 +530,24 @@ async def save_image(image_b64: str, prompt: str = "Unknown prompt", width: int
         if not image_b64:
             return {"error": "No image data provided"}
 
-        # Декодируем base64
+        # Длина корректного base64 кратна 4 — отсекаем мусор до декодирования
+        if len(image_b64) % 4:
+            return {"error": "Invalid base64 data: bad length"}
+
+        # Декодируем base64 SIMD-декодером pybase64 со строгой проверкой алфавита
         try:
-            image_data = base64.b64decode(image_b64)
+            image_data = pybase64.b64decode(image_b64, validate=True)
         except Exception as e:
             return {"error": f"Invalid base64 data: {str(e)}"}
 
-        # Создаем уникальное имя файла
-        filename = f"image_{uuid.uuid4().hex[:8]}_{int(time.time())}.png"
-        filepath = os.path.join(UPLOAD_FOLDER, filename)
+        # Создаем уникальное имя файла: 72 случайных бита, время создания
+        # хранится в метаданных
+        filename = f"image_{secrets.token_urlsafe(9)}.png"
+        filepath = f"{UPLOAD_FOLDER}/{filename}"
 
-        # Обрабатываем изображение с помощью PIL
-        try:
-            with Image.open(BytesIO(image_data)) as img:
-                # Конвертируем в RGB если нужно
-                if img.mode != 'RGB':
-                    img = img.convert('RGB')
-
-                original_size = img.size
-                logger.info(f"Исходный размер изображения от Gemini: {original_size}")
-                logger.info(f"Целевой размер: {width}x{height}")
-
-                # Изменяем размер с сохранением пропорций БЕЗ обрезки
-                # Вычисляем коэффициент масштабирования (уменьшаем, чтобы поместилось)
-                ratio = min(width / original_size[0], height / original_size[1])
-                new_size = (int(original_size[0] * ratio), int(original_size[1] * ratio))
-
-                # Масштабируем изображение
-                img = img.resize(new_size, Image.Resampling.LANCZOS)
-                logger.info(f"Размер после масштабирования: {img.size}")
-
-                # Создаем новое изображение целевого размера с черным фоном
-                result = Image.new('RGB', (width, height), (0, 0, 0))
-
-                # Вычисляем позицию для центрирования
-                paste_x = (width - new_size[0]) // 2
-                paste_y = (height - new_size[1]) // 2
-
-                # Вставляем масштабированное изображение по центру
-                result.paste(img, (paste_x, paste_y))
-                logger.info(f"Изображение вставлено в позицию: ({paste_x}, {paste_y})")
-
-                # Заполняем черные полосы сгенерированным контентом
-                result = await fill_black_borders(result, prompt)
-
-                logger.info(f"Финальный размер: {result.size}")
-
-                # Сохраняем как PNG
-                result.save(filepath, 'PNG')
-                actual_width, actual_height = result.size
-
-        except Exception as e:
-            # Если PIL не может обработать, сохраняем как есть
-            with open(filepath, 'wb') as f:
-                f.write(image_data)
-            actual_width, actual_height = width, height
+        # Декодирование, масштабирование и запись файла блокируют event loop,
+        # поэтому выполняются в пуле потоков
+        actual_width, actual_height = await asyncio.to_thread(_save_sync, image_data, filepath, width, height)
 
         # Добавляем метаданные
         generation_time = 0  # Время генерации уже прошло
@@ -396,28 +578,32 @@ def list_images() -> dict:
         metadata = load_metadata()
         images = []
 
-        for filename in os.listdir(UPLOAD_FOLDER):
-            if filename.endswith('.png'):
-                filepath = os.path.join(UPLOAD_FOLDER, filename)
-                if os.path.isfile(filepath):
-                    file_size = os.path.getsize(filepath)
-
-                    # Получаем метаданные
-                    img_metadata = metadata.get(filename, {})
-
-                    images.append({
-                        'filename': filename,
-                        'size': file_size,
-                        'width': img_metadata.get('width', 'Unknown'),
-                        'height': img_metadata.get('height', 'Unknown'),
-                        'prompt': img_metadata.get('prompt', 'Unknown'),
-                        'model': img_metadata.get('model', 'Unknown'),
-                        'generation_time': img_metadata.get('generation_time', 0),
-                        'created': img_metadata.get('created', 'Unknown')
-                    })
+        # scandir отдает DirEntry с закешированным типом и stat,
+        # без отдельных isfile/getsize на каждый файл
+        with os.scandir(UPLOAD_FOLDER) as it:
+            for entry in it:
+                if not entry.name.endswith('.png') or not entry.is_file(follow_symlinks=False):
+                    continue
+
+                # Получаем метаданные
+                img_metadata = metadata.get(entry.name, {})
+                st = entry.stat()
+
+                images.append({
+                    'filename': entry.name,
+                    'size': st.st_size,
+                    'width': img_metadata.get('width', 'Unknown'),
+                    'height': img_metadata.get('height', 'Unknown'),
+                    'prompt': img_metadata.get('prompt', 'Unknown'),
+                    'model': img_metadata.get('model', 'Unknown'),
+                    'generation_time': img_metadata.get('generation_time', 0),
+                    'created': img_metadata.get('created', 'Unknown'),
+                    # Для записей без отметки времени берем mtime файла
+                    'created_ts': img_metadata.get('created_ts', st.st_mtime)
+                })
 
         # Сортируем по дате создания (новые сначала)
-        images.sort(key=lambda x: x['created'], reverse=True)
+        images.sort(key=lambda x: x['created_ts'], reverse=True)
 
         return {'images': images}
 
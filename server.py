@@ -1,30 +1,112 @@
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse, HTMLResponse, FileResponse
+from fastapi.responses import ORJSONResponse, HTMLResponse, FileResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.gzip import GZipMiddleware
+from starlette.datastructures import UploadFile
 import os
+import io
+import hashlib
+import itertools
+import mimetypes
+from email.utils import formatdate, parsedate_to_datetime
+from datetime import timezone
 import time
+import asyncio
+import multiprocessing
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import ProcessPoolExecutor
 import uvicorn
-from image_service import generate_image_async, save_image, list_images
-
-app = FastAPI(title="Neuroevent AI Image Generator")
-
-# Добавляем сжатие GZip для всех ответов
-app.add_middleware(GZipMiddleware, minimum_size=1000)
-
-# Добавляем CORS middleware
+import orjson
+import pybase64
+from PIL import Image
+from pydantic import BaseModel, ValidationError, constr
+from image_service import generate_image_async, save_image, list_images, create_http_client, atomic_write, atomic_write_bytes, UPLOAD_FOLDER, PNG_COMPRESS_LEVEL, png_dimensions
+
+logger = logging.getLogger(__name__)
+
+# JSON-ответы сериализуем через orjson: ответы /api/generate содержат мегабайты base64
+app = FastAPI(title="Neuroevent AI Image Generator", default_response_class=ORJSONResponse)
+
+# PNG уже сжат DEFLATE, а base64 от PNG почти не сжимается — gzip на этих путях только тратит CPU
+NO_GZIP_PREFIXES = ("/api/generate", "/api/generated_images/", "/api/download/", "/generated_images/")
+
+class SelectiveGZipMiddleware(GZipMiddleware):
+    """GZip для всех ответов, кроме изображений и base64-изображений"""
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith(NO_GZIP_PREFIXES):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+# Добавляем сжатие GZip для текстовых ответов
+# Уровень 5: почти та же степень сжатия HTML/JSON, что и по умолчанию 9, при заметно меньших затратах CPU.
+# Добавляется раньше CORS и потому оказывается внутри него: preflight OPTIONS не проходит через gzip
+app.add_middleware(SelectiveGZipMiddleware, minimum_size=1024, compresslevel=5)
+
+# Разрешенные источники через запятую, например "https://example.com,http://localhost:8002"
+CORS_ORIGINS = [origin.strip() for origin in os.getenv("CORS_ORIGINS", "*").split(",") if origin.strip()]
+
+# Добавляем CORS middleware: явные методы и заголовки вместо "*", а max_age
+# позволяет браузеру кешировать preflight на сутки
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # В продакшене лучше указать конкретные домены
+    allow_origins=CORS_ORIGINS,  # В продакшене лучше указать конкретные домены
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["Content-Type", "Authorization"],
+    max_age=86400,
 )
 
+def start_log_queue() -> QueueListener:
+    """Переносит обработчики корневого логгера в фоновый поток за очередью"""
+    # Форматирование и запись в stdout выполняет поток QueueListener, а event loop
+    # только кладет запись в очередь и не ждет медленный терминал
+    root = logging.getLogger()
+    handlers = root.handlers or [logging.StreamHandler()]
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    root.handlers = [QueueHandler(log_queue)]
+    listener.start()
+    return listener
+
+def stop_log_queue(listener: QueueListener):
+    """Дописывает записи из очереди и возвращает обработчики корневому логгеру"""
+    listener.stop()
+    logging.getLogger().handlers = list(listener.handlers)
+
+# Число воркеров uvicorn и размер пула обработки изображений в каждом из них:
+# пул создается в каждом воркере, поэтому ядра делятся между воркерами
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", max(2, (os.cpu_count() or 1) // 2)))
+IMAGE_POOL_WORKERS = int(os.environ.get("IMAGE_POOL_WORKERS", max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY)))
+
+# Имена сохраненных изображений: проверка существования без обращения к диску
+KNOWN_IMAGES: set[str] = set()
+
+@app.on_event("startup")
+async def startup():
+    """Запускаем очередь логов, HTTP-клиент Gemini API и пул процессов для обработки изображений"""
+    app.state.log_listener = start_log_queue()
+    # Клиент живет столько же, сколько приложение: TLS-соединения с upstream переиспользуются
+    app.state.http = create_http_client()
+    # spawn вместо fork: форк процесса с работающим event loop и потоками небезопасен
+    app.state.pool = ProcessPoolExecutor(max_workers=IMAGE_POOL_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    # Один scandir при старте вместо stat() на каждый запрос изображения
+    with os.scandir(UPLOAD_FOLDER) as it:
+        KNOWN_IMAGES.update(entry.name for entry in it if entry.is_file(follow_symlinks=False))
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Закрываем HTTP-клиент Gemini API, пул процессов и очередь логов при остановке сервера"""
+    await app.state.http.aclose()
+    app.state.pool.shutdown(wait=False, cancel_futures=True)
+    stop_log_queue(app.state.log_listener)
+
 # Монтируем статические файлы
 app.mount("/assets", StaticFiles(directory="assets"), name="assets")
-app.mount("/generated_images", StaticFiles(directory="generated_images"), name="generated_images")
+app.mount("/generated_images", StaticFiles(directory=UPLOAD_FOLDER), name="generated_images")
 
 def get_home_page():
     """Вспомогательная функция для получения index.html (главная страница)"""
@@ -42,173 +124,317 @@ def get_demo_page():
     except FileNotFoundError:
         return "<h1>Demo</h1><p>Демо страница не найдена</p>"
 
+# Страницы статичны: читаем их один раз при импорте в bytes, а не на каждый запрос
+_PAGES = {
+    "index.html": get_home_page().encode("utf-8"),
+    "demo.html": get_demo_page().encode("utf-8"),
+}
+# Сильный ETag по содержимому: повторный запрос браузера получает 304 без тела
+_PAGE_ETAGS = {name: f'"{hashlib.blake2b(data, digest_size=16).hexdigest()}"' for name, data in _PAGES.items()}
+PAGE_CACHE_CONTROL = "public, max-age=3600"
+
+def page_response(request: Request, name: str) -> Response:
+    """Отдает закешированную страницу или 304, если у клиента актуальная версия"""
+    headers = {"ETag": _PAGE_ETAGS[name], "Cache-Control": PAGE_CACHE_CONTROL}
+    if_none_match = request.headers.get("if-none-match", "")
+    if _PAGE_ETAGS[name] in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+    return HTMLResponse(_PAGES[name], headers=headers)
+
 @app.get("/", response_class=HTMLResponse)
-async def home():
+async def home(request: Request):
     """Главная страница"""
-    return HTMLResponse(get_home_page())
+    return page_response(request, "index.html")
 
 @app.get("/demo-page", response_class=HTMLResponse)
-async def demo():
+async def demo(request: Request):
     """Демо страница"""
-    return HTMLResponse(get_demo_page())
+    return page_response(request, "demo.html")
 
 @app.get("/demo.html", response_class=HTMLResponse)
-async def demo_html():
+async def demo_html(request: Request):
     """Демо страница (для обратной совместимости)"""
-    return HTMLResponse(get_demo_page())
+    return page_response(request, "demo.html")
 
 @app.get("/api/test")
 async def api_test():
     """Тестовый API endpoint"""
-    return JSONResponse({"message": "API работает"})
+    return ORJSONResponse({"message": "API работает"})
+
+class GenerateRequest(BaseModel):
+    """Параметры генерации: промпт проверяется в pydantic-core, а не Python-кодом"""
+    prompt: constr(strip_whitespace=True, min_length=3, max_length=4000)
+    width: int | None = 1024
+    height: int | None = 1024
+    # True — сгенерировать новый вариант в обход кеша промптов
+    regenerate: bool = False
+
+_PROMPT_ERRORS = {
+    "string_too_short": "Prompt must be at least 3 characters long",
+    "string_too_long": "Prompt must be less than 4000 characters",
+}
+
+def _validation_error_response(exc: ValidationError) -> ORJSONResponse:
+    """Превращает первую ошибку валидации в ответ прежнего формата {"error": ...}"""
+    err = exc.errors()[0]
+    if err["loc"][:1] == ("prompt",):
+        if err["type"] in ("missing", "string_type") or err.get("input") == "":
+            message = "Prompt is required"
+        else:
+            message = _PROMPT_ERRORS.get(err["type"], f"Invalid prompt: {err['msg']}")
+    else:
+        field = ".".join(str(part) for part in err["loc"]) or "request"
+        message = f"Invalid {field}: {err['msg']}"
+    return ORJSONResponse({"error": message}, status_code=400)
+
+async def _generate_from_request(request: Request):
+    """Разбирает запрос генерации (FormData или JSON), проверяет промпт и вызывает Gemini API.
+
+    Возвращает словарь с результатом или ORJSONResponse с ошибкой для клиента.
+    """
+    # Проверяем тип контента
+    content_type = request.headers.get('content-type', '')
+
+    if 'multipart/form-data' in content_type:
+        # Обработка FormData (новый алгоритм с изображениями)
+        form = await request.form()
+        try:
+            params = GenerateRequest.model_validate({
+                "prompt": form.get("prompt"),
+                "width": form.get("width") or None,
+                "height": form.get("height") or None,
+                "regenerate": form.get("regenerate") or False,
+            })
+        except ValidationError as e:
+            return _validation_error_response(e)
+        prompt = params.prompt
+        width = params.width or 1024
+        height = params.height or 1024
+        reference_image_raw = form.get("reference_image")  # base64 референсное изображение
+        timestamp = form.get("timestamp")
+
+        logger.info(f"🖼️ Получен запрос с референсным изображением. Timestamp: {timestamp}")
+        logger.info(f"📝 Промпт: {prompt[:100]}...")
+        logger.info(f"📐 Размер: {width}x{height}")
+        
+        # Обрабатываем референсное изображение
+        reference_image = None
+        if reference_image_raw:
+            # Если это UploadFile, читаем содержимое
+            if isinstance(reference_image_raw, UploadFile):
+                image_bytes = await reference_image_raw.read()
+                reference_image = pybase64.b64encode_as_string(image_bytes)
+                logger.info(f"📸 Референсное изображение получено как UploadFile, размер: {len(image_bytes)} байт")
+            elif isinstance(reference_image_raw, str):
+                # Если это строка data URL или чистый base64 — нормализуем к чистому base64
+                ref_str = reference_image_raw.strip()
+                if ref_str.startswith('data:image') and ',' in ref_str:
+                    ref_str = ref_str.split(',')[1]
+                    logger.info("🔧 Удален префикс data URL у референсного изображения")
+                reference_image = ref_str
+                logger.info(f"📸 Референсное изображение получено как строка base64, длина: {len(reference_image)} символов")
+            else:
+                logger.warning(f"⚠️ Неизвестный тип референсного изображения: {type(reference_image_raw)}")
+
+    elif 'application/json' in content_type:
+        # Обработка JSON (старый формат): разбор и проверка целиком в pydantic-core
+        try:
+            params = GenerateRequest.model_validate_json(await request.body())
+        except ValidationError as e:
+            return _validation_error_response(e)
+        prompt = params.prompt
+        width = params.width or 1024
+        height = params.height or 1024
+        reference_image = None
+
+    else:
+        return ORJSONResponse({"error": "Unsupported content type"}, status_code=400)
+
+    # Если есть референсное изображение, улучшаем промпт
+    if reference_image:
+        enhanced_prompt = f"Измени это изображение, добавив: {prompt}. Сохрани композицию, цветовую палитру и художественные элементы из исходного изображения, но добавь новые элементы согласно промпту."
+        logger.info(f"🎨 Улучшенный промпт для референсного изображения: {enhanced_prompt[:150]}...")
+        logger.info("📸 Референсное изображение будет отправлено в Gemini API")
+    else:
+        enhanced_prompt = prompt
+
+    # Генерируем изображение через Gemini API
+    # Передаем референсное изображение напрямую в API
+    result = await generate_image_async(
+        enhanced_prompt, width, height, reference_image,
+        client=request.app.state.http, use_cache=not params.regenerate,
+    )
+
+    if "error" in result:
+        return ORJSONResponse({"error": result["error"]}, status_code=400)
+
+    logger.info(f"✅ Изображение сгенерировано успешно. Референсное изображение использовано: {reference_image is not None}")
+
+    return {
+        "image_b64": result["image_b64"],
+        "model": result["model"],
+        "generation_time": result["generation_time"],
+        "prompt": prompt,
+        "enhanced_prompt": enhanced_prompt if reference_image else None,
+        "reference_image_used": reference_image is not None
+    }
 
 @app.post("/api/generate")
 async def api_generate(request: Request):
     """API для генерации изображений через Gemini 2.5 Flash Image Preview API"""
     try:
-        # Проверяем тип контента
-        content_type = request.headers.get('content-type', '')
+        generated = await _generate_from_request(request)
+        if isinstance(generated, Response):
+            return generated
+
+        # Клиент, принимающий image/png, получает сырые байты: на треть меньше
+        # трафика и без base64 в обе стороны при последующем сохранении
+        if 'image/png' in request.headers.get('accept', ''):
+            return Response(
+                content=pybase64.b64decode(generated["image_b64"]),
+                media_type="image/png",
+                headers={
+                    "X-Model": generated["model"],
+                    "X-Generation-Time": str(generated["generation_time"]),
+                },
+            )
 
-        if 'multipart/form-data' in content_type:
-            # Обработка FormData (новый алгоритм с изображениями)
-            form = await request.form()
-            prompt = form.get("prompt")
-            width = int(form.get("width", 1024)) if form.get("width") else 1024
-            height = int(form.get("height", 1024)) if form.get("height") else 1024
-            reference_image_raw = form.get("reference_image")  # base64 референсное изображение
-            timestamp = form.get("timestamp")
-
-            print(f"🖼️ Получен запрос с референсным изображением. Timestamp: {timestamp}")
-            print(f"📝 Промпт: {prompt[:100] if prompt else 'None'}...")
-            print(f"📐 Размер: {width}x{height}")
-            
-            # Обрабатываем референсное изображение
-            reference_image = None
-            if reference_image_raw:
-                # Если это UploadFile, читаем содержимое
-                from fastapi import UploadFile
-                if isinstance(reference_image_raw, UploadFile):
-                    image_bytes = await reference_image_raw.read()
-                    import base64
-                    reference_image = base64.b64encode(image_bytes).decode('utf-8')
-                    print(f"📸 Референсное изображение получено как UploadFile, размер: {len(image_bytes)} байт")
-                elif isinstance(reference_image_raw, str):
-                    # Если это строка data URL или чистый base64 — нормализуем к чистому base64
-                    ref_str = reference_image_raw.strip()
-                    if ref_str.startswith('data:image') and ',' in ref_str:
-                        ref_str = ref_str.split(',')[1]
-                        print("🔧 Удален префикс data URL у референсного изображения")
-                    reference_image = ref_str
-                    print(f"📸 Референсное изображение получено как строка base64, длина: {len(reference_image)} символов")
-                else:
-                    print(f"⚠️ Неизвестный тип референсного изображения: {type(reference_image_raw)}")
-
-        elif 'application/json' in content_type:
-            # Обработка JSON (старый формат)
-            data = await request.json()
-            prompt = data.get("prompt")
-            width = data.get("width", 1024)
-            height = data.get("height", 1024)
-            reference_image = None
+        return ORJSONResponse({"success": True, **generated})
 
-        else:
-            return JSONResponse({"error": "Unsupported content type"}, status_code=400)
+    except Exception as e:
+        logger.exception("API generate failed")
+        return ORJSONResponse({"error": f"Internal server error: {str(e)}"}, status_code=500)
 
-        if not prompt:
-            return JSONResponse({"error": "Prompt is required"}, status_code=400)
+STREAM_CHUNK_SIZE = 64 * 1024
 
-        if len(prompt.strip()) < 3:
-            return JSONResponse({"error": "Prompt must be at least 3 characters long"}, status_code=400)
+async def _iter_chunks(data: bytes):
+    """Отдает байты кусками, чтобы отправка началась до формирования всего тела"""
+    for offset in range(0, len(data), STREAM_CHUNK_SIZE):
+        yield data[offset:offset + STREAM_CHUNK_SIZE]
 
-        if len(prompt.strip()) > 4000:
-            return JSONResponse({"error": "Prompt must be less than 4000 characters"}, status_code=400)
+@app.post("/api/generate_stream")
+async def api_generate_stream(request: Request):
+    """Генерация изображения с потоковой отдачей PNG вместо base64 в JSON"""
+    try:
+        generated = await _generate_from_request(request)
+        if isinstance(generated, Response):
+            return generated
+
+        # Метаданные уходят в заголовки, тело — сырые байты PNG без base64
+        png_bytes = pybase64.b64decode(generated["image_b64"])
+        return StreamingResponse(
+            _iter_chunks(png_bytes),
+            media_type="image/png",
+            headers={
+                "Content-Length": str(len(png_bytes)),
+                "X-Model": generated["model"],
+                "X-Generation-Time": str(generated["generation_time"]),
+            },
+        )
 
-        # Если есть референсное изображение, улучшаем промпт
-        if reference_image:
-            enhanced_prompt = f"Измени это изображение, добавив: {prompt}. Сохрани композицию, цветовую палитру и художественные элементы из исходного изображения, но добавь новые элементы согласно промпту."
-            print(f"🎨 Улучшенный промпт для референсного изображения: {enhanced_prompt[:150]}...")
-            print(f"📸 Референсное изображение будет отправлено в Gemini API")
-        else:
-            enhanced_prompt = prompt
+    except Exception as e:
+        logger.exception("API generate stream failed")
+        return ORJSONResponse({"error": f"Internal server error: {str(e)}"}, status_code=500)
 
-        # Генерируем изображение через Gemini API
-        # Передаем референсное изображение напрямую в API
-        result = await generate_image_async(enhanced_prompt, width or 1024, height or 1024, reference_image)
+def _save_png_job(image_data: bytes, filepath: str, width: int, height: int) -> tuple[int, int, int]:
+    """Нормализует изображение в RGB PNG и записывает на диск.
 
-        if "error" in result:
-            return JSONResponse({"error": result["error"]}, status_code=400)
+    Выполняется в пуле процессов, поэтому должна оставаться функцией верхнего
+    уровня. Возвращает ширину, высоту и размер файла в байтах.
+    """
+    try:
+        # Открываем изображение с помощью PIL для обработки
+        with Image.open(io.BytesIO(image_data)) as img:
+            # Конвертируем в RGB если нужно
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
 
-        response_data = {
-            "success": True,
-            "image_b64": result["image_b64"],
-            "model": result["model"],
-            "generation_time": result["generation_time"],
-            "prompt": prompt,
-            "enhanced_prompt": enhanced_prompt if reference_image else None,
-            "reference_image_used": reference_image is not None
-        }
+            # Сохраняем как PNG через временный файл и атомарное переименование
+            atomic_write(filepath, lambda f: img.save(f, 'PNG', compress_level=PNG_COMPRESS_LEVEL, optimize=False))
+            actual_width, actual_height = img.size
 
-        print(f"✅ Изображение сгенерировано успешно. Референсное изображение использовано: {reference_image is not None}")
+    except Exception as e:
+        # Если PIL не может обработать, сохраняем как есть
+        atomic_write_bytes(filepath, image_data)
+        actual_width, actual_height = width, height
 
-        return JSONResponse(response_data)
+    return actual_width, actual_height, os.path.getsize(filepath)
 
-    except Exception as e:
-        print(f"❌ Error in API generate: {e}")
-        return JSONResponse({"error": f"Internal server error: {str(e)}"}, status_code=500)
+# next() у itertools.count атомарен под GIL — блокировка не нужна
+_START_NS = time.time_ns()
+_FILE_COUNTER = itertools.count()
 
 @app.post("/api/save_image")
 async def api_save_image(request: Request):
     """API для сохранения изображений"""
     try:
-        import base64
-        from PIL import Image
-        import io
+        content_type = request.headers.get('content-type', '')
 
-        data = await request.json()
-        image_b64 = data.get("image_b64")
-        prompt = data.get("prompt", "Unknown prompt")
-        width = data.get("width", 1024)
-        height = data.get("height", 1024)
+        if 'multipart/form-data' in content_type:
+            # Бинарная загрузка PNG (Blob из /api/generate): без base64 вовсе
+            form = await request.form()
+            upload = form.get("file")
+            prompt = form.get("prompt") or "Unknown prompt"
+            try:
+                width = int(form.get("width") or 1024)
+                height = int(form.get("height") or 1024)
+            except (TypeError, ValueError):
+                return ORJSONResponse({"error": "Width and height must be integers"}, status_code=400)
 
-        if not image_b64:
-            return JSONResponse({"error": "No image data provided"}, status_code=400)
+            if not isinstance(upload, UploadFile):
+                return ORJSONResponse({"error": "No image data provided"}, status_code=400)
 
-        # Убираем префикс data:image/png;base64, если он есть
-        if image_b64.startswith('data:image'):
-            image_b64 = image_b64.split(',')[1]
+            image_data = await upload.read()
+            if not image_data:
+                return ORJSONResponse({"error": "No image data provided"}, status_code=400)
 
-        # Декодируем base64
-        try:
-            image_data = base64.b64decode(image_b64)
-        except Exception as e:
-            return JSONResponse({"error": f"Invalid base64 data: {str(e)}"}, status_code=400)
+        else:
+            # Многомегабайтное тело разбираем через orjson, а не stdlib json
+            data = orjson.loads(await request.body())
+            image_b64 = data.get("image_b64")
+            prompt = data.get("prompt", "Unknown prompt")
+            width = data.get("width", 1024)
+            height = data.get("height", 1024)
 
-        # Создаем уникальное имя файла
-        filename = f"generated_{int(time.time())}.png"
-        filepath = os.path.join("generated_images", filename)
+            if not image_b64:
+                return ORJSONResponse({"error": "No image data provided"}, status_code=400)
+
+            # Убираем префикс data:image/png;base64, если он есть — срезом, без split по всей строке
+            if image_b64.startswith('data:image'):
+                image_b64 = image_b64[image_b64.find(',', 0, 100) + 1:]
+
+            # Длина корректного base64 кратна 4 — отсекаем мусор до декодирования
+            if len(image_b64) % 4:
+                return ORJSONResponse({"error": "Invalid base64 data: bad length"}, status_code=400)
+
+            # Декодируем base64 со строгой проверкой алфавита
+            try:
+                image_data = pybase64.b64decode(image_b64, validate=True)
+            except Exception as e:
+                return ORJSONResponse({"error": f"Invalid base64 data: {str(e)}"}, status_code=400)
+
+        # Создаем уникальное имя файла: метка старта процесса + счетчик не
+        # повторяются даже при нескольких сохранениях в одну секунду
+        filename = f"generated_{_START_NS}_{next(_FILE_COUNTER)}.png"
+        filepath = f"{UPLOAD_FOLDER}/{filename}"
+
+        dimensions = png_dimensions(image_data)
+        if dimensions and image_data[24:26] == b'\x08\x02':
+            # Уже 8-битный RGB PNG: размеры берем из заголовка IHDR и пишем байты
+            # как есть; RGBA, палитра и 16 бит идут через конвертацию в RGB
+            actual_width, actual_height = dimensions
+            await asyncio.to_thread(atomic_write_bytes, filepath, image_data)
+            file_size = len(image_data)
+        else:
+            # Декодирование и кодирование PNG упираются в CPU и GIL, поэтому
+            # выполняются в пуле процессов, а не потоков
+            loop = asyncio.get_running_loop()
+            actual_width, actual_height, file_size = await loop.run_in_executor(
+                app.state.pool, _save_png_job, image_data, filepath, width, height
+            )
+        KNOWN_IMAGES.add(filename)
 
-        # Сохраняем изображение
-        try:
-            # Открываем изображение с помощью PIL для обработки
-            with Image.open(io.BytesIO(image_data)) as img:
-                # Конвертируем в RGB если нужно
-                if img.mode != 'RGB':
-                    img = img.convert('RGB')
-
-                # Сохраняем как PNG
-                img.save(filepath, 'PNG')
-                actual_width, actual_height = img.size
-
-        except Exception as e:
-            # Если PIL не может обработать, сохраняем как есть
-            with open(filepath, 'wb') as f:
-                f.write(image_data)
-            actual_width, actual_height = width, height
-
-        # Получаем размер файла
-        file_size = os.path.getsize(filepath)
-
-        return JSONResponse({
+        return ORJSONResponse({
             "success": True,
             "filename": filename,
             "width": actual_width,
@@ -221,59 +447,177 @@ async def api_save_image(request: Request):
         })
 
     except Exception as e:
-        return JSONResponse({"error": f"Error saving image: {str(e)}"}, status_code=500)
+        logger.exception("API save_image failed")
+        return ORJSONResponse({"error": f"Error saving image: {str(e)}"}, status_code=500)
+
+# Mock список изображений для тестирования: сериализуем один раз при импорте
+_IMAGES_BLOB = orjson.dumps({
+    "images": [
+        {
+            "filename": "test_image.png",
+            "size": 1000,
+            "width": 512,
+            "height": 512,
+            "prompt": "Test image",
+            "model": "Test Model",
+            "generation_time": 0,
+            "created": "2025-01-01T00:00:00"
+        }
+    ]
+})
 
 @app.get("/api/images")
 async def api_list_images():
     """API для получения списка изображений"""
-    # Mock список изображений для тестирования
-    return JSONResponse({
-        "images": [
-            {
-                "filename": "test_image.png",
-                "size": 1000,
-                "width": 512,
-                "height": 512,
-                "prompt": "Test image",
-                "model": "Test Model",
-                "generation_time": 0,
-                "created": "2025-01-01T00:00:00"
-            }
-        ]
-    })
-
-@app.get("/api/generated_images/{filename}")
-async def api_serve_image(filename: str):
+    return Response(content=_IMAGES_BLOB, media_type="application/json")
+
+def resolve_image(filename: str, not_found: str) -> str:
+    """Возвращает путь к сохраненному изображению или поднимает 404"""
+    # Имя приходит из URL: не выпускаем его за пределы папки изображений
+    if "/" in filename or "\\" in filename or ".." in filename:
+        raise HTTPException(status_code=404, detail=not_found)
+    filepath = f"{UPLOAD_FOLDER}/{filename}"
+    if filename not in KNOWN_IMAGES:
+        # Файл мог сохранить другой воркер uvicorn — проверяем диск и запоминаем
+        if not os.path.isfile(filepath):
+            raise HTTPException(status_code=404, detail=not_found)
+        KNOWN_IMAGES.add(filename)
+    return filepath
+
+# Имена файлов уникальны и содержимое не меняется — браузер может кешировать неделю без перепроверки
+IMAGE_CACHE_CONTROL = "public, max-age=604800, immutable"
+
+def is_not_modified(request: Request, mtime: float) -> bool:
+    """Проверяет If-Modified-Since: True, если у клиента актуальная копия"""
+    since = request.headers.get("if-modified-since")
+    # RFC 9110 §13.1.3: при наличии If-None-Match заголовок If-Modified-Since игнорируется
+    if not since or "if-none-match" in request.headers:
+        return False
+    try:
+        since_dt = parsedate_to_datetime(since)
+    except (TypeError, ValueError):
+        return False
+    # Даты с зоной -0000 разбираются как naive — это UTC, а не локальное время
+    if since_dt.tzinfo is None:
+        since_dt = since_dt.replace(tzinfo=timezone.utc)
+    return int(mtime) <= since_dt.timestamp()
+
+def parse_range(header: str | None, size: int) -> tuple[int, int] | None:
+    """Разбирает одиночный диапазон "bytes=start-end"; None — отдать файл целиком"""
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start_s, _, end_s = header[6:].strip().partition("-")
+    # Только десятичные цифры: "5--3", "+5" и т.п. — некорректный Range, его игнорируем
+    if not all(part.isascii() and part.isdigit() for part in (start_s, end_s) if part) or not (start_s or end_s):
+        return None
+    if start_s:
+        start = int(start_s)
+        if end_s and int(end_s) < start:
+            return None
+        end = min(int(end_s), size - 1) if end_s else size - 1
+    else:
+        # bytes=-N: последние N байт файла
+        start, end = max(size - int(end_s), 0), size - 1
+    if start > end or start >= size:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+def _iter_file_range(filepath: str, start: int, length: int):
+    """Читает диапазон файла кусками; StreamingResponse выполняет синхронный генератор в пуле потоков"""
+    with open(filepath, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(STREAM_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+def image_file_response(request: Request, name: str, not_found: str, **kwargs) -> Response:
+    """FileResponse для сохраненного изображения с Last-Modified и ответом 304"""
+    filepath = resolve_image(name, not_found)
+    try:
+        st = os.stat(filepath)
+    except FileNotFoundError:
+        KNOWN_IMAGES.discard(name)
+        raise HTTPException(status_code=404, detail=not_found)
+
+    headers = {"Cache-Control": IMAGE_CACHE_CONTROL, "Accept-Ranges": "bytes"}
+    if is_not_modified(request, st.st_mtime):
+        headers["Last-Modified"] = formatdate(st.st_mtime, usegmt=True)
+        return Response(status_code=304, headers=headers)
+
+    byte_range = parse_range(request.headers.get("range"), st.st_size)
+    if byte_range:
+        # Докачка и перемотка: отдаем только запрошенный диапазон кусками
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{st.st_size}"
+        headers["Content-Length"] = str(end - start + 1)
+        headers["Last-Modified"] = formatdate(st.st_mtime, usegmt=True)
+        if kwargs.get("filename"):
+            headers["Content-Disposition"] = f'attachment; filename="{kwargs["filename"]}"'
+        media_type = kwargs.get("media_type") or mimetypes.guess_type(filepath)[0] or "application/octet-stream"
+        if request.method == "HEAD":
+            return Response(status_code=206, headers=headers, media_type=media_type)
+        return StreamingResponse(
+            _iter_file_range(filepath, start, end - start + 1),
+            status_code=206,
+            headers=headers,
+            media_type=media_type,
+        )
+
+    # stat_result передаем готовым, чтобы FileResponse не делал второй stat();
+    # Last-Modified и Content-Length он выставит сам. method нужен, чтобы на HEAD
+    # он отдал только заголовки, а не читал файл целиком
+    response = FileResponse(filepath, stat_result=st, headers=headers, method=request.method, **kwargs)
+    # Перепроверка идет только по Last-Modified: без ETag браузер не шлет If-None-Match,
+    # который по RFC 9110 отменяет If-Modified-Since
+    del response.headers["etag"]
+    return response
+
+@app.api_route("/api/generated_images/{filename}", methods=["GET", "HEAD"])
+async def api_serve_image(request: Request, filename: str):
     """Отдает изображение по имени файла"""
     try:
-        filepath = os.path.join("generated_images", filename)
-        if os.path.exists(filepath):
-            return FileResponse(filepath)
-        else:
-            raise HTTPException(status_code=404, detail="Image not found")
+        return image_file_response(request, filename, "Image not found")
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error serving image: {str(e)}")
 
-@app.get("/api/download/{filename}")
-async def api_download_image(filename: str):
+@app.api_route("/api/download/{filename}", methods=["GET", "HEAD"])
+async def api_download_image(request: Request, filename: str):
     """Скачивание изображения"""
     try:
-        filepath = os.path.join("generated_images", filename)
-        if os.path.exists(filepath):
-            return FileResponse(
-                filepath,
-                media_type='application/octet-stream',
-                filename=filename
-            )
-        else:
-            raise HTTPException(status_code=404, detail="File not found")
+        return image_file_response(
+            request,
+            filename,
+            "File not found",
+            media_type='application/octet-stream',
+            filename=filename
+        )
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error downloading image: {str(e)}")
 
 if __name__ == "__main__":
     import os
     port = int(os.environ.get("PORT", 8002))  # Используем свободный порт 8002 по умолчанию
-    print(f"🚀 Запуск Neuroevent веб-сервиса на порту {port}...")
-    print(f"📱 Откройте браузер: http://localhost:{port}")
-    print(f"🎨 API доступно по адресу: http://localhost:{port}/api/")
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # Несколько воркеров обходят GIL на JSON/base64; для них uvicorn нужна строка импорта приложения
+    workers = WEB_CONCURRENCY
+    logger.info(f"🚀 Запуск Neuroevent веб-сервиса на порту {port} ({workers} воркеров)...")
+    logger.info(f"📱 Откройте браузер: http://localhost:{port}")
+    logger.info(f"🎨 API доступно по адресу: http://localhost:{port}/api/")
+    # Access-лог на каждый запрос — заметная доля CPU под нагрузкой, поэтому выключен
+    uvicorn.run(
+        "server:app",
+        host="0.0.0.0",
+        port=port,
+        loop="uvloop",
+        http="httptools",
+        workers=workers,
+        backlog=2048,
+        access_log=False,
+        log_level="warning",
+    )